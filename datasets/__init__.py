@@ -3,6 +3,7 @@
 import torch.utils.data
 import torchvision
 
+from .coco import SharedCocoIndex
 from .mixed import CustomCocoDetection
 from .coco import build as build_coco
 from .flickr import build as build_flickr
@@ -14,6 +15,9 @@ def get_coco_api_from_dataset(dataset):
         if isinstance(dataset, torch.utils.data.Subset):
             dataset = dataset.dataset
     if isinstance(dataset, (torchvision.datasets.CocoDetection, CustomCocoDetection)):
+        if isinstance(dataset.coco, SharedCocoIndex):
+            # the datasets only hold the memory-mapped index, the evaluators need the full api
+            return dataset.coco.load_full()
         return dataset.coco
 
 
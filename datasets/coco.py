@@ -5,19 +5,193 @@ COCO dataset which returns image_id for evaluation.
 
 Mostly copy-paste from https://github.com/pytorch/vision/blob/13b35ff/references/detection/coco_utils.py
 """
+import hashlib
+import mmap
+import os
+import pickle
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
 from pathlib import Path
 
 import torch
 import torch.utils.data
 import torchvision
 from pycocotools import mask as coco_mask
+from pycocotools.coco import COCO
 
 import datasets.transforms as T
 
 
+def _cache_file(ann_file, cache_dir, suffix):
+    ann_file = Path(ann_file).resolve()
+    stat = ann_file.stat()
+    key = hashlib.sha1(f"{ann_file}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    return Path(cache_dir) / f"{ann_file.stem}_{key}{suffix}"
+
+
+def load_coco_api(ann_file, cache_dir=None):
+    """Builds the COCO api of an annotation file.
+
+    Parsing and indexing the large annotation files takes a while at every launch. If cache_dir is given, the indexed
+    COCO object is pickled there on first use, keyed on the path, size and modification time of the annotation file,
+    and loaded back from the cache on the next launches.
+    """
+    if not cache_dir:
+        return COCO(ann_file)
+    ann_file = Path(ann_file).resolve()
+    cache_file = _cache_file(ann_file, cache_dir, ".pkl")
+    if cache_file.exists():
+        print(f"loading annotations of {ann_file} from {cache_file}")
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    coco = COCO(str(ann_file))
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so that concurrent processes never read a partial cache file
+    tmp_file = cache_file.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp_file, "wb") as f:
+        pickle.dump(coco, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return coco
+
+
+class _SharedImgs(Mapping):
+    """Read-only view of the images of a SharedCocoIndex, as the imgs dict of the COCO api"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, img_id):
+        return self.index.loadImgs(img_id)[0]
+
+    def __iter__(self):
+        return iter(self.index.img_ids)
+
+    def __len__(self):
+        return len(self.index.img_ids)
+
+
+class SharedCocoIndex:
+    """Read-only subset of the COCO api, over an index of the annotations memory-mapped from disk.
+
+    Each image and annotation is pickled separately in a single file, which starts with the sorted ids and the offsets
+    of the records. The file is mapped instead of loaded, so that its pages are shared through the page cache by the
+    dataloader workers and the ranks of a node, rather than each process holding its own COCO object. Pickling the
+    index, eg to start a worker, only pickles its path.
+    Only the lookups of the datasets are supported, the full api used by the evaluators is loaded with load_full.
+    """
+
+    def __init__(self, index_file, ann_file, cache_dir):
+        self.index_file = str(index_file)
+        self.ann_file = ann_file
+        self.cache_dir = cache_dir
+        self._buffer = None
+
+    @staticmethod
+    def write(coco, index_file):
+        img_ids = sorted(coco.imgs.keys())
+        ann_ids = sorted(coco.anns.keys())
+        assert all(isinstance(i, int) for i in img_ids + ann_ids), "the shared index only supports integer ids"
+        img_records = [
+            pickle.dumps((coco.imgs[i], [ann["id"] for ann in coco.imgToAnns[i]]), protocol=pickle.HIGHEST_PROTOCOL)
+            for i in img_ids
+        ]
+        ann_records = [pickle.dumps(coco.anns[i], protocol=pickle.HIGHEST_PROTOCOL) for i in ann_ids]
+        # header: number of images and annotations, then the ids and the offsets of each table
+        offset = 8 * (2 + len(img_ids) + len(img_ids) + 1 + len(ann_ids) + len(ann_ids) + 1)
+        offsets = []
+        for records in (img_records, ann_records):
+            table = [offset]
+            for record in records:
+                offset += len(record)
+                table.append(offset)
+            offsets.append(table)
+        header = [len(img_ids), len(ann_ids)] + img_ids + offsets[0] + ann_ids + offsets[1]
+        # write to a temporary file first so that concurrent processes never map a partial index
+        tmp_file = f"{index_file}.tmp{os.getpid()}"
+        with open(tmp_file, "wb") as f:
+            f.write(array("q", header).tobytes())
+            for record in img_records + ann_records:
+                f.write(record)
+        os.replace(tmp_file, index_file)
+
+    def _open(self):
+        if self._buffer is not None:
+            return
+        with open(self.index_file, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._buffer)
+        num_imgs, num_anns = view[:16].cast("q")
+        tables = []
+        start = 16
+        for length in (num_imgs, num_imgs + 1, num_anns, num_anns + 1):
+            tables.append(view[start : start + 8 * length].cast("q"))
+            start += 8 * length
+        self._img_ids, self._img_offsets, self._ann_ids, self._ann_offsets = tables
+
+    def _load(self, ids, offsets, key):
+        idx = bisect_left(ids, key)
+        if idx == len(ids) or ids[idx] != key:
+            raise KeyError(key)
+        return pickle.loads(self._buffer[offsets[idx] : offsets[idx + 1]])
+
+    @property
+    def img_ids(self):
+        self._open()
+        return self._img_ids
+
+    @property
+    def imgs(self):
+        return _SharedImgs(self)
+
+    def getAnnIds(self, imgIds):
+        self._open()
+        if isinstance(imgIds, (list, tuple)):
+            return [i for img_id in imgIds for i in self._load(self._img_ids, self._img_offsets, img_id)[1]]
+        return self._load(self._img_ids, self._img_offsets, imgIds)[1]
+
+    def loadAnns(self, ids):
+        self._open()
+        if isinstance(ids, (list, tuple)):
+            return [self._load(self._ann_ids, self._ann_offsets, i) for i in ids]
+        return [self._load(self._ann_ids, self._ann_offsets, ids)]
+
+    def loadImgs(self, ids):
+        self._open()
+        if isinstance(ids, (list, tuple)):
+            return [self._load(self._img_ids, self._img_offsets, i)[0] for i in ids]
+        return [self._load(self._img_ids, self._img_offsets, ids)[0]]
+
+    def load_full(self):
+        """Returns the complete COCO api of the annotation file"""
+        return load_coco_api(self.ann_file, self.cache_dir)
+
+    def __getstate__(self):
+        # the mapping is re-opened lazily by the process unpickling the index
+        return {"index_file": self.index_file, "ann_file": self.ann_file, "cache_dir": self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._buffer = None
+
+
+def load_shared_coco_api(ann_file, cache_dir):
+    """Returns the memory-mapped SharedCocoIndex of an annotation file, building it in cache_dir on first use"""
+    index_file = _cache_file(ann_file, cache_dir, ".idx")
+    if not index_file.exists():
+        index_file.parent.mkdir(parents=True, exist_ok=True)
+        SharedCocoIndex.write(load_coco_api(ann_file, cache_dir), index_file)
+    return SharedCocoIndex(index_file, ann_file, cache_dir)
+
+
 class ModulatedDetection(torchvision.datasets.CocoDetection):
-    def __init__(self, img_folder, ann_file, transforms, return_masks, return_tokens, tokenizer, is_train=False):
-        super(ModulatedDetection, self).__init__(img_folder, ann_file)
+    def __init__(
+        self, img_folder, ann_file, transforms, return_masks, return_tokens, tokenizer, is_train=False, cache_dir=None
+    ):
+        # the annotations are loaded below, possibly from the cache, instead of by CocoDetection
+        super(ModulatedDetection, self).__init__(img_folder, None)
+        self.coco = load_shared_coco_api(ann_file, cache_dir) if cache_dir else COCO(ann_file)
+        self.ids = list(sorted(self.coco.imgs.keys()))
         self._transforms = transforms
         self.prepare = ConvertCocoPolysToMask(return_masks, return_tokens, tokenizer=tokenizer)
         self.is_train = is_train
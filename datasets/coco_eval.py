@@ -21,9 +21,10 @@ from util.dist import all_gather
 
 
 class CocoEvaluator(object):
-    def __init__(self, coco_gt, iou_types, useCats=False):
+    def __init__(self, coco_gt, iou_types, useCats=False, copy_gt=True):
         assert isinstance(iou_types, (list, tuple))
-        coco_gt = copy.deepcopy(coco_gt)
+        if copy_gt:
+            coco_gt = copy.deepcopy(coco_gt)
         self.coco_gt = coco_gt
 
         self.iou_types = iou_types
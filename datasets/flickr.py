@@ -16,8 +16,9 @@ from models.unitab import target2gtind as target2gtind_caption
 class FlickrDetection(ModulatedDetection):
     def __init__(self, img_folder, ann_file, transforms, return_masks, return_tokens, tokenizer, is_train=False,\
         max_decoding_step=256, num_queries=200, do_flickrgrounding=None, unitab_pretrain=False, pretrain_seqcrop=None,\
-        multitask=False, GT_type='', refexp_dataset_name=''):
-        super(FlickrDetection, self).__init__(img_folder, ann_file, transforms, return_masks, return_tokens, tokenizer, is_train)
+        multitask=False, GT_type='', refexp_dataset_name='', cache_dir=None):
+        super(FlickrDetection, self).__init__(img_folder, ann_file, transforms, return_masks, return_tokens, tokenizer, is_train,\
+            cache_dir=cache_dir)
         self.vqav2 = 'vqav2caption' in str(ann_file)
         self.tokenizer = tokenizer
         self.max_decoding_step = max_decoding_step
@@ -166,5 +167,6 @@ def build(image_set, args):
         multitask=(not args.unitab_pretrain and args.GT_type == "mergedGT_pretrain"), ## MTL finetune
         GT_type=args.GT_type,
         refexp_dataset_name=args.refexp_dataset_name,
+        cache_dir=args.dataset_cache_dir,
     )
     return dataset
@@ -396,12 +396,16 @@ class FlickrEvaluator(object):
         top_k=(1, 5, 10, -1),
         iou_thresh=0.5,
         merge_boxes=False,
+        recall_evaluator=None,
     ):
         assert isinstance(top_k, (list, tuple))
 
-        self.evaluator = Flickr30kEntitiesRecallEvaluator(
-            flickr_path, subset=subset, topk=top_k, iou_thresh=iou_thresh, merge_boxes=merge_boxes, verbose=False
-        )
+        # the recall evaluator only reads the annotations, so an already loaded one can be reused
+        if recall_evaluator is None:
+            recall_evaluator = Flickr30kEntitiesRecallEvaluator(
+                flickr_path, subset=subset, topk=top_k, iou_thresh=iou_thresh, merge_boxes=merge_boxes, verbose=False
+            )
+        self.evaluator = recall_evaluator
         self.predictions = []
         self.results = None
 
@@ -438,6 +442,15 @@ class FlickrEvaluator(object):
         return None, None
 
 
+def load_roberta_vocab():
+    """Returns the mapping from the token ids to the words of the roberta vocabulary, extended with the box tokens"""
+    word2ind_roberta_vocab = json.load(open('roberta-base-vocab-withbbox.json','r'))
+    roberta_vocab = {}
+    for key in word2ind_roberta_vocab:
+        roberta_vocab[word2ind_roberta_vocab[key]] = key
+    return roberta_vocab
+
+
 class FlickrCaptionEvaluator(object):
     def __init__(
         self,
@@ -446,7 +459,8 @@ class FlickrCaptionEvaluator(object):
         top_k=(1, 5, 10, -1),
         iou_thresh=0.5,
         merge_boxes=False,
-        exp_id=None
+        exp_id=None,
+        roberta_vocab=None,
     ):
         assert isinstance(top_k, (list, tuple))
 
@@ -454,10 +468,9 @@ class FlickrCaptionEvaluator(object):
         self.gts = []
         self.index = []
         self.exp_id = exp_id
-        word2ind_roberta_vocab = json.load(open('roberta-base-vocab-withbbox.json','r'))
-        self.roberta_vocab = {}
-        for key in word2ind_roberta_vocab:
-            self.roberta_vocab[word2ind_roberta_vocab[key]] = key
+        if roberta_vocab is None:
+            roberta_vocab = load_roberta_vocab()
+        self.roberta_vocab = roberta_vocab
         self.results = None
 
     def accumulate(self):
@@ -4,10 +4,11 @@ from pathlib import Path
 from typing import Any, Callable, Optional, Tuple
 
 from PIL import Image
+from pycocotools.coco import COCO
 from torchvision.datasets.vision import VisionDataset
 from transformers import RobertaTokenizerFast
 
-from .coco import ConvertCocoPolysToMask, make_coco_transforms
+from .coco import ConvertCocoPolysToMask, load_shared_coco_api, make_coco_transforms
 
 import torch
 import random
@@ -26,11 +27,10 @@ class CustomCocoDetection(VisionDataset):
         transform: Optional[Callable] = None,
         target_transform: Optional[Callable] = None,
         transforms: Optional[Callable] = None,
+        cache_dir: Optional[str] = None,
     ) -> None:
         super(CustomCocoDetection, self).__init__(root_coco, transforms, transform, target_transform)
-        from pycocotools.coco import COCO
-
-        self.coco = COCO(annFile)
+        self.coco = load_shared_coco_api(annFile, cache_dir) if cache_dir else COCO(annFile)
         self.ids = list(sorted(self.coco.imgs.keys()))
         self.root_coco = root_coco
         self.root_vg = root_vg
@@ -59,8 +59,8 @@ class MixedDetection(CustomCocoDetection):
     """Same as the modulated detection dataset, except with multiple img sources"""
 
     def __init__(self, img_folder_coco, img_folder_vg, ann_file, transforms, return_masks, return_tokens, tokenizer, is_train=False,\
-        max_decoding_step=256, num_queries=200, unitab_pretrain=False, pretrain_seqcrop=None):
-        super(MixedDetection, self).__init__(img_folder_coco, img_folder_vg, ann_file)
+        max_decoding_step=256, num_queries=200, unitab_pretrain=False, pretrain_seqcrop=None, cache_dir=None):
+        super(MixedDetection, self).__init__(img_folder_coco, img_folder_vg, ann_file, cache_dir=cache_dir)
         self._transforms = transforms
         self.prepare = ConvertCocoPolysToMask(return_masks, return_tokens, tokenizer=tokenizer)
         self.tokenizer = tokenizer
@@ -160,7 +160,8 @@ def build(image_set, args):
         max_decoding_step=args.max_decoding_step,
         num_queries=args.num_queries,
         unitab_pretrain=args.unitab_pretrain,
-        pretrain_seqcrop=args.pretrain_seqcrop
+        pretrain_seqcrop=args.pretrain_seqcrop,
+        cache_dir=args.dataset_cache_dir,
     )
 
     return dataset
@@ -20,8 +20,9 @@ from .coco import ModulatedDetection, make_coco_transforms
 
 class RefExpDetection(ModulatedDetection):
     def __init__(self, img_folder, ann_file, transforms, return_tokens, tokenizer, is_train=False,\
-        max_decoding_step=256, num_queries=200):
-        super(RefExpDetection, self).__init__(img_folder, ann_file, transforms, False, return_tokens, tokenizer)
+        max_decoding_step=256, num_queries=200, cache_dir=None):
+        super(RefExpDetection, self).__init__(img_folder, ann_file, transforms, False, return_tokens, tokenizer,\
+            cache_dir=cache_dir)
         self.tokenizer = tokenizer
         self.max_decoding_step = max_decoding_step
         self.num_queries = num_queries
@@ -43,9 +44,10 @@ class RefExpDetection(ModulatedDetection):
 
 # Main RefCOCO
 class RefExpEvaluator(object):
-    def __init__(self, refexp_gt, iou_types, k=[1], thresh_iou=0.5):
+    def __init__(self, refexp_gt, iou_types, k=[1], thresh_iou=0.5, copy_gt=True):
         assert isinstance(k, (list, tuple))
-        refexp_gt = copy.deepcopy(refexp_gt)
+        if copy_gt:
+            refexp_gt = copy.deepcopy(refexp_gt)
         self.refexp_gt = refexp_gt
         self.iou_types = iou_types
         self.img_ids = self.refexp_gt.imgs.keys()
@@ -139,5 +141,6 @@ def build(image_set, args):
         is_train=image_set=="train",
         max_decoding_step=args.max_decoding_step,
         num_queries=args.num_queries,
+        cache_dir=args.dataset_cache_dir,
     )
     return dataset
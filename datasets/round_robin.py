@@ -0,0 +1,86 @@
+"""
+Multi-task training dataset interleaving the samples of several datasets.
+"""
+import torch
+import torch.utils.data
+
+import util.dist as dist
+
+
+class RoundRobinIterableDataset(torch.utils.data.IterableDataset):
+    """Streams the samples of several datasets, interleaved by a weighted round-robin.
+
+    Unlike a ConcatDataset behind a random sampler, which draws from each dataset in proportion to its size, the
+    share of each dataset in the stream is given by its weight, so that a large dataset does not starve the others.
+    The dataset is its own sampler: every epoch, the indices of each dataset are shuffled with a seed shared by all
+    processes, and each (rank, dataloader worker) pair iterates over its own shard of them. A dataset whose shard
+    runs out before the end of the epoch starts over.
+    Each worker yields a multiple of batch_size samples, so that no partial batch is dropped and the length of the
+    dataloader is the number of batches it produces.
+    Args:
+        datasets: list of map-style datasets
+        weights: relative sampling weight of each dataset, equal weights if None.
+        seed: seed of the shuffling, combined with the epoch
+        batch_size: batch size of the dataloader
+        num_workers: number of workers of the dataloader
+    """
+
+    def __init__(self, datasets, weights=None, seed=0, batch_size=1, num_workers=0):
+        super().__init__()
+        if weights is None:
+            weights = [1.0] * len(datasets)
+        assert len(weights) == len(datasets), "expected one weight per dataset"
+        self.datasets = datasets
+        self.weights = [float(w) for w in weights]
+        self.seed = seed
+        self.epoch = 0
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        # the process group is not available in the dataloader workers
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _num_samples(self, worker_id, num_workers):
+        # the samples per rank are those of a DistributedSampler over the concatenated datasets, split between the
+        # workers and rounded down to full batches
+        rank_samples = sum(len(d) for d in self.datasets) // self.world_size
+        worker_samples = rank_samples // num_workers + int(worker_id < rank_samples % num_workers)
+        return worker_samples // self.batch_size * self.batch_size
+
+    def __len__(self):
+        return sum(self._num_samples(worker_id, self.num_workers) for worker_id in range(self.num_workers))
+
+    def __iter__(self):
+        # persistent dataloader workers keep their copy of the dataset, so they count the epochs themselves
+        epoch = self.epoch
+        self.epoch += 1
+
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        num_shards = self.world_size * num_workers
+        shard_id = self.rank * num_workers + worker_id
+        assert num_workers == self.num_workers, "num_workers does not match the one of the dataloader"
+        num_samples = self._num_samples(worker_id, num_workers)
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        shard_indices = []
+        for d in self.datasets:
+            indices = torch.randperm(len(d), generator=generator).tolist()
+            shard_indices.append(indices[shard_id::num_shards] or indices)
+
+        # smooth weighted round-robin: deterministic, and each dataset gets its share at any point of the epoch
+        total_weight = sum(self.weights)
+        credits = [0.0] * len(self.datasets)
+        positions = [0] * len(self.datasets)
+        for _ in range(num_samples):
+            for i, w in enumerate(self.weights):
+                credits[i] += w
+            i = max(range(len(credits)), key=credits.__getitem__)
+            credits[i] -= total_weight
+            indices = shard_indices[i]
+            yield self.datasets[i][indices[positions[i] % len(indices)]]
+            positions[i] += 1
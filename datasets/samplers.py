@@ -0,0 +1,116 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+"""
+Batch sampler grouping images with similar aspect ratios, which reduces the padding of the batched images.
+
+Mostly copy-paste from https://github.com/pytorch/vision/blob/main/references/detection/group_by_aspect_ratio.py
+"""
+import bisect
+import copy
+from collections import defaultdict
+from itertools import chain, repeat
+
+import numpy as np
+import torch.utils.data
+from torch.utils.data import BatchSampler, ConcatDataset
+
+
+def _repeat_to_at_least(iterable, n):
+    repeat_times = -(-n // len(iterable))
+    repeated = chain.from_iterable(repeat(iterable, repeat_times))
+    return list(repeated)
+
+
+class GroupedBatchSampler(BatchSampler):
+    """
+    Wraps another sampler to yield a mini-batch of indices.
+    It enforces that the batch only contain elements from the same group.
+    It also tries to provide mini-batches which follows an ordering which is
+    as close as possible to the ordering from the original sampler.
+    Arguments:
+        sampler (Sampler): Base sampler.
+        group_ids (list[int]): If the sampler produces indices in range [0, N),
+            `group_ids` must be a list of `N` ints which contains the group id of each sample.
+            The group ids must be a continuous set of integers starting from
+            0, i.e. they must be in the range [0, num_groups).
+        batch_size (int): Size of mini-batch.
+    """
+
+    def __init__(self, sampler, group_ids, batch_size):
+        self.sampler = sampler
+        self.group_ids = group_ids
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        buffer_per_group = defaultdict(list)
+        samples_per_group = defaultdict(list)
+
+        num_batches = 0
+        for idx in self.sampler:
+            group_id = self.group_ids[idx]
+            buffer_per_group[group_id].append(idx)
+            samples_per_group[group_id].append(idx)
+            if len(buffer_per_group[group_id]) == self.batch_size:
+                yield buffer_per_group[group_id]
+                num_batches += 1
+                del buffer_per_group[group_id]
+            assert len(buffer_per_group[group_id]) < self.batch_size
+
+        # now we have run out of elements that satisfy
+        # the group criteria, let's return the remaining
+        # elements so that the size of the sampler is
+        # deterministic
+        expected_num_batches = len(self)
+        num_remaining = expected_num_batches - num_batches
+        if num_remaining > 0:
+            # for the remaining batches, take first the buffers with the largest number
+            # of elements
+            for group_id, _ in sorted(buffer_per_group.items(), key=lambda x: len(x[1]), reverse=True):
+                remaining = self.batch_size - len(buffer_per_group[group_id])
+                samples_from_group_id = _repeat_to_at_least(samples_per_group[group_id], remaining)
+                buffer_per_group[group_id].extend(samples_from_group_id[:remaining])
+                assert len(buffer_per_group[group_id]) == self.batch_size
+                yield buffer_per_group[group_id]
+                num_remaining -= 1
+                if num_remaining == 0:
+                    break
+        assert num_remaining == 0
+
+    def __len__(self):
+        # same as a BatchSampler with drop_last=True
+        return len(self.sampler) // self.batch_size
+
+
+def _compute_aspect_ratios(dataset):
+    """Reads the width / height ratio of the images from the annotations, without loading the images."""
+    if isinstance(dataset, ConcatDataset):
+        return list(chain.from_iterable(_compute_aspect_ratios(d) for d in dataset.datasets))
+    if isinstance(dataset, torch.utils.data.Subset):
+        aspect_ratios = _compute_aspect_ratios(dataset.dataset)
+        return [aspect_ratios[i] for i in dataset.indices]
+    if hasattr(dataset, "coco") and hasattr(dataset, "ids"):
+        aspect_ratios = []
+        for img_id in dataset.ids:
+            img_info = dataset.coco.imgs[img_id]
+            aspect_ratios.append(float(img_info["width"]) / float(img_info["height"]))
+        return aspect_ratios
+    raise ValueError(f"Can not compute the aspect ratios of the images of {type(dataset).__name__}")
+
+
+def _quantize(x, bins):
+    bins = copy.deepcopy(bins)
+    bins = sorted(bins)
+    quantized = list(map(lambda y: bisect.bisect_right(bins, y), x))
+    return quantized
+
+
+def create_aspect_ratio_groups(dataset, k=0):
+    """Assigns each image of the dataset to one of 2k+2 aspect ratio bins, log-spaced between 1/2 and 2"""
+    aspect_ratios = _compute_aspect_ratios(dataset)
+    bins = (2 ** np.linspace(-1, 1, 2 * k + 1)).tolist() if k > 0 else [1.0]
+    groups = _quantize(aspect_ratios, bins)
+    # count number of elements per group
+    counts = np.unique(groups, return_counts=True)[1]
+    fbins = [0] + bins + [np.inf]
+    print("Using {} as bins for aspect ratio quantization".format(fbins))
+    print("Count of instances per bin: {}".format(counts))
+    return groups
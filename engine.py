@@ -17,7 +17,8 @@ from datasets.flickr_eval import FlickrEvaluator, FlickrCaptionEvaluator
 from datasets.refexp import RefExpEvaluator
 from util.metrics import MetricLogger, SmoothedValue
 from util.misc import targets_to
-from util.optim import adjust_learning_rate, update_ema
+from util.optim import ModelEma, adjust_learning_rate
+from util.pinned_pool import PinnedBatchPool
 
 import colossalai.engine as Engine
 
@@ -31,11 +32,16 @@ def train_one_epoch(
     epoch: int,
     args,
     max_norm: float = 0,
-    model_ema: Optional[torch.nn.Module] = None,
+    model_ema: Optional[ModelEma] = None,
     colossalai_engine: Engine = None,
     deepspeed_engine = None,
+    scaler: Optional[torch.cuda.amp.GradScaler] = None,
+    amp_dtype: Optional[torch.dtype] = None,
+    pinned_pool: Optional[PinnedBatchPool] = None,
 ):
     model.train()
+    if scaler is None:
+        scaler = torch.cuda.amp.GradScaler(enabled=False)
     if colossalai_engine is not None:
         colossalai_engine.train()
     if criterion is not None:
@@ -46,15 +52,24 @@ def train_one_epoch(
     metric_logger.add_meter("lr_text_encoder", SmoothedValue(window_size=1, fmt="{value:.6f}"))
     header = "Epoch: [{}]".format(epoch)
     print_freq = 1000
+    dtype = None
     if args.from_deepspeed and deepspeed_engine.fp16_enabled():
         dtype = torch.half
     num_training_steps = int(len(data_loader) * args.epochs)
+    # the loss is accumulated on device, and only read back at the logging steps to avoid a sync at every step
+    running_loss = torch.zeros(1, device=device)
+    num_steps = 0
     for i, batch_dict in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
         curr_step = epoch * len(data_loader) + i
-        samples = batch_dict["samples"].to(device, dtype)
-        positive_map = batch_dict["positive_map"].to(device, dtype) if "positive_map" in batch_dict else None
+        log_step = i % print_freq == 0 or i == len(data_loader) - 1
+        if pinned_pool is not None:
+            batch_dict = pinned_pool.pin_batch(batch_dict)
+        samples = batch_dict["samples"].to(device, dtype, non_blocking=True)
+        positive_map = batch_dict["positive_map"].to(device, dtype, non_blocking=True) if "positive_map" in batch_dict else None
         targets = batch_dict["targets"]
-        answers = {k: v.to(device, dtype) for k, v in batch_dict["answers"].items()} if "answers" in batch_dict else None
+        answers = {k: v.to(device, dtype, non_blocking=True) for k, v in batch_dict["answers"].items()} if "answers" in batch_dict else None
+        if pinned_pool is not None:
+            pinned_pool.record()
         captions = [t["caption"].to(dtype) for t in targets]
 
         targets = targets_to(targets, device)
@@ -63,47 +78,56 @@ def train_one_epoch(
             samples = samples.to(torch.half)
             print(samples)
             print(captions)
-        memory_cache = model(samples, captions, targets, encode_and_save=True)
-        if colossalai_engine is not None:
-            colossalai_engine.zero_grad()
-            outputs = colossalai_engine(samples, captions, targets, encode_and_save=False, memory_cache=memory_cache)
-        elif deepspeed_engine is not None:
-            deepspeed_engine.zero_grad()
-            outputs = deepspeed_engine(samples, captions, targets, encode_and_save=False, memory_cache=memory_cache)
-        else:
-            outputs = model(samples, captions, targets, encode_and_save=False, memory_cache=memory_cache)
-
-        loss_dict = {}
-        if criterion is not None:
+        with torch.cuda.amp.autocast(enabled=amp_dtype is not None, dtype=amp_dtype or torch.float16):
+            memory_cache = model(samples, captions, targets, encode_and_save=True)
             if colossalai_engine is not None:
-                loss_dict.update(colossalai_engine.criterion(outputs, targets, positive_map))
+                colossalai_engine.zero_grad()
+                outputs = colossalai_engine(samples, captions, targets, encode_and_save=False, memory_cache=memory_cache)
+            elif deepspeed_engine is not None:
+                deepspeed_engine.zero_grad()
+                outputs = deepspeed_engine(samples, captions, targets, encode_and_save=False, memory_cache=memory_cache)
             else:
-                loss_dict.update(criterion(outputs, targets, positive_map))
+                outputs = model(samples, captions, targets, encode_and_save=False, memory_cache=memory_cache)
 
-        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+            loss_dict = {}
+            if criterion is not None:
+                if colossalai_engine is not None:
+                    loss_dict.update(colossalai_engine.criterion(outputs, targets, positive_map))
+                else:
+                    loss_dict.update(criterion(outputs, targets, positive_map))
 
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = dist.reduce_dict(loss_dict)
-        loss_dict_reduced_unscaled = {f"{k}_unscaled": v for k, v in loss_dict_reduced.items()}
-        loss_dict_reduced_scaled = {k: v * weight_dict[k] for k, v in loss_dict_reduced.items() if k in weight_dict}
-        losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
+            losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+
+        running_loss += losses.detach().float()
+        num_steps += 1
+
+        if log_step:
+            # reduce losses over all GPUs for logging purposes
+            loss_dict_reduced = dist.reduce_dict(loss_dict)
+            loss_dict_reduced_unscaled = {f"{k}_unscaled": v for k, v in loss_dict_reduced.items()}
+            loss_dict_reduced_scaled = {k: v * weight_dict[k] for k, v in loss_dict_reduced.items() if k in weight_dict}
+            losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
 
-        loss_value = losses_reduced_scaled.item()
+            loss_value = losses_reduced_scaled.item()
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
+            # a non finite loss since the last logging step propagates to the running loss
+            if not math.isfinite(loss_value) or not math.isfinite(running_loss.item()):
+                print("Loss is {}, stopping training".format(loss_value))
+                print(loss_dict_reduced)
+                sys.exit(1)
 
         if colossalai_engine is not None:
             colossalai_engine.backward(losses)
         elif deepspeed_engine is not None:
             deepspeed_engine.backward(losses)
         else:
-            optimizer.zero_grad()
-            losses.backward()
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(losses).backward()
 
         if max_norm > 0:
+            if colossalai_engine is None and deepspeed_engine is None:
+                # the gradients have to be unscaled before clipping them
+                scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
 
         if colossalai_engine is not None:
@@ -111,7 +135,8 @@ def train_one_epoch(
         elif deepspeed_engine is not None:
             deepspeed_engine.step()
         else:
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
 
         adjust_learning_rate(
             optimizer,
@@ -121,19 +146,23 @@ def train_one_epoch(
             args=args,
         )
         if model_ema is not None:
-            update_ema(model, model_ema, args.ema_decay)
+            model_ema.update(args.ema_decay)
 
-        metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
+        if log_step:
+            metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(lr_backbone=optimizer.param_groups[1]["lr"])
         metric_logger.update(lr_text_encoder=optimizer.param_groups[2]["lr"])
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    # the other losses are averaged over the logging steps, the total loss over every step
+    stats["loss"] = dist.reduce_dict({"loss": running_loss})["loss"].item() / max(num_steps, 1)
+    return stats
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def evaluate(
     model: torch.nn.Module,
     criterion: Optional[torch.nn.Module],
@@ -143,6 +172,8 @@ def evaluate(
     evaluator_list,
     device: torch.device,
     args,
+    amp_dtype: Optional[torch.dtype] = None,
+    pinned_pool: Optional[PinnedBatchPool] = None,
 ):
     model.eval()
     if criterion is not None:
@@ -152,21 +183,24 @@ def evaluate(
     header = "Test:"
 
     for batch_dict in metric_logger.log_every(data_loader, 10, header):
-        samples = batch_dict["samples"].to(device)
-        positive_map = batch_dict["positive_map"].to(device) if "positive_map" in batch_dict else None
+        if pinned_pool is not None:
+            batch_dict = pinned_pool.pin_batch(batch_dict)
+        samples = batch_dict["samples"].to(device, non_blocking=True)
+        positive_map = batch_dict["positive_map"].to(device, non_blocking=True) if "positive_map" in batch_dict else None
         targets = batch_dict["targets"]
-        answers = {k: v.to(device) for k, v in batch_dict["answers"].items()} if "answers" in batch_dict else None
+        answers = {k: v.to(device, non_blocking=True) for k, v in batch_dict["answers"].items()} if "answers" in batch_dict else None
         captions = [t["caption"] for t in targets]
 
         targets = targets_to(targets, device)
 
         memory_cache = None
-        memory_cache = model(samples, captions, targets, encode_and_save=True)
-        outputs = model(samples, captions, targets, encode_and_save=False, memory_cache=memory_cache)
+        with torch.cuda.amp.autocast(enabled=amp_dtype is not None, dtype=amp_dtype or torch.float16):
+            memory_cache = model(samples, captions, targets, encode_and_save=True)
+            outputs = model(samples, captions, targets, encode_and_save=False, memory_cache=memory_cache)
 
-        loss_dict = {}
-        if criterion is not None:
-            loss_dict.update(criterion(outputs, targets, positive_map))
+            loss_dict = {}
+            if criterion is not None:
+                loss_dict.update(criterion(outputs, targets, positive_map))
 
         # reduce losses over all GPUs for logging purposes
         loss_dict_reduced = dist.reduce_dict(loss_dict)
@@ -187,7 +221,7 @@ def evaluate(
                 image_ids = [t["original_img_id"] for t in targets]
                 sentence_ids = [t["sentence_id"] for t in targets]
                 items_per_batch_element = [t["nb_eval"] for t in targets]
-                positive_map_eval = batch_dict["positive_map_eval"].to(device)
+                positive_map_eval = batch_dict["positive_map_eval"].to(device, non_blocking=True)
                 flickr_results = postprocessors["flickr_bbox"](
                     outputs, orig_target_sizes, positive_map_eval, items_per_batch_element
                 )
@@ -211,6 +245,9 @@ def evaluate(
                 if isinstance(evaluator, FlickrCaptionEvaluator):
                     evaluator.update(outputs)
 
+        if pinned_pool is not None:
+            pinned_pool.record()
+
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
@@ -1,14 +1,16 @@
 # Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 import argparse
+import atexit
+import copy
 import datetime
 import json
 import os
 import random
 import time
 from collections import namedtuple
-from copy import deepcopy
-from functools import partial
+from contextlib import nullcontext
+from functools import lru_cache, partial
 from pathlib import Path
 from xml.sax.handler import feature_string_interning
 import psutil
@@ -20,10 +22,20 @@ from torch.utils.data import ConcatDataset, DataLoader, DistributedSampler
 
 import util.dist as dist
 import util.misc as utils
+from util.checkpoint import AsyncCheckpointWriter
+from util.optim import CPUOffloadOptimizer, ModelEma, build_multi_tensor_optimizer
+from util.pinned_pool import PinnedBatchPool
 from datasets import build_dataset, get_coco_api_from_dataset
 from datasets.coco_eval import CocoEvaluator
-from datasets.flickr_eval import FlickrEvaluator, FlickrCaptionEvaluator
+from datasets.flickr_eval import (
+    Flickr30kEntitiesRecallEvaluator,
+    FlickrCaptionEvaluator,
+    FlickrEvaluator,
+    load_roberta_vocab,
+)
 from datasets.refexp import RefExpEvaluator
+from datasets.round_robin import RoundRobinIterableDataset
+from datasets.samplers import GroupedBatchSampler, create_aspect_ratio_groups
 from engine import evaluate, train_one_epoch
 from models import build_model
 from models.postprocessors import build_postprocessors
@@ -31,7 +43,6 @@ from models.postprocessors import build_postprocessors
 import colossalai
 from colossalai.core import global_context as gpc
 from colossalai.logging import disable_existing_loggers, get_dist_logger
-from colossalai.utils import save_checkpoint
 from colossalai.zero.init_ctx import ZeroInitContext
 from colossalai.zero.shard_utils import BucketTensorShardStrategy, TensorShardStrategy
 
@@ -41,7 +52,7 @@ from colossalai.gemini.chunk import ChunkManager
 from colossalai.utils.model.colo_init_context import ColoInitContext
 from colossalai.utils import get_current_device
 from colossalai.nn.parallel import ZeroDDP
-from colossalai.nn.optimizer import HybridAdam
+from colossalai.nn.optimizer import CPUAdam, HybridAdam
 from colossalai.zero import ZeroOptimizer
 from colossalai.tensor import ProcessGroup
 
@@ -71,10 +82,23 @@ def get_args_parser():
     parser.add_argument(
         "--combine_datasets_val", nargs="+", help="List of datasets to combine for eval", default=["flickr"]
     )
+    parser.add_argument(
+        "--multitask_weights",
+        nargs="+",
+        type=float,
+        default=None,
+        help="Sampling weight of each of the combine_datasets in multi-task finetuning, equal weights by default",
+    )
 
     parser.add_argument("--coco_path", type=str, default="")
     parser.add_argument("--vg_img_path", type=str, default="")
     parser.add_argument("--vg_ann_path", type=str, default="")
+    parser.add_argument(
+        "--dataset_cache_dir",
+        type=str,
+        default="",
+        help="Directory where the parsed annotation files are cached between launches (eg .cache), empty for no caching",
+    )
 
     # Training hyper-parameters
     parser.add_argument("--lr", default=1e-4, type=float)
@@ -85,7 +109,20 @@ def get_args_parser():
     parser.add_argument("--epochs", default=40, type=int)
     parser.add_argument("--lr_drop", default=35, type=int)
     parser.add_argument("--optimizer", default="adam", type=str)
+    parser.add_argument(
+        "--offload_optim",
+        action="store_true",
+        help="Whether to keep the adam states and master weights in pinned CPU memory, updated with colossalai's CPUAdam",
+    )
     parser.add_argument("--clip_max_norm", default=0.1, type=float, help="gradient clipping max norm")
+    parser.add_argument("--amp", action="store_true", help="Whether to use automatic mixed precision")
+    parser.add_argument(
+        "--amp_dtype",
+        default="auto",
+        type=str,
+        choices=("auto", "fp16", "bf16"),
+        help="Autocast dtype used with --amp. auto picks bf16 if the GPU supports it, fp16 otherwise",
+    )
     parser.add_argument(
         "--eval_skip",
         default=1,
@@ -115,6 +152,17 @@ def get_args_parser():
         "--freeze_text_encoder", action="store_true", help="Whether to freeze the weights of the text encoder"
     )
 
+    parser.add_argument(
+        "--bf16_frozen_text_encoder",
+        action="store_true",
+        help="Whether to store and run the text encoder in bf16, requires --freeze_text_encoder",
+    )
+    parser.add_argument(
+        "--gradient_checkpoint",
+        action="store_true",
+        help="Whether to recompute the activations of the transformer and last backbone stage in backward",
+    )
+
     parser.add_argument(
         "--text_encoder_type",
         default="roberta-base",
@@ -171,6 +219,7 @@ def get_args_parser():
     parser.add_argument("--max_decoding_step", default=256, type=int, help="max_decoding_step for text generation")
     parser.add_argument("--num_queries", default=200, type=int, help="Number of object tokens")
     parser.add_argument("--pre_norm", action="store_true")
+    parser.add_argument("--compile", action="store_true", help="Whether to compile the model with torch.compile")
 
     # Run specific
     parser.add_argument("--test", action="store_true", help="Whether to run evaluation on val or test set")
@@ -178,11 +227,39 @@ def get_args_parser():
     parser.add_argument("--output-dir", default="", help="path where to save, empty for no saving")
     parser.add_argument("--device", default="cuda", help="device to use for training / testing")
     parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument(
+        "--deterministic",
+        action="store_true",
+        help="Whether to use deterministic cuDNN algorithms",
+    )
+    parser.add_argument(
+        "--cudnn_benchmark",
+        action="store_true",
+        help="Whether to let cuDNN autotune the conv algorithms, only worth it when the input shapes rarely change",
+    )
     parser.add_argument("--resume", default="", help="resume from checkpoint")
     parser.add_argument("--load", default="", help="resume from checkpoint")
     parser.add_argument("--start-epoch", default=0, type=int, metavar="N", help="start epoch")
     parser.add_argument("--eval", action="store_true", help="Only run evaluation")
     parser.add_argument("--num_workers", default=5, type=int)
+    parser.add_argument(
+        "--aspect_ratio_group_factor",
+        default=3,
+        type=int,
+        help="Batch together training images of similar aspect ratios, from 2k+2 bins, to reduce padding. -1 disables it",
+    )
+    parser.add_argument(
+        "--collate_to_device",
+        action="store_true",
+        help="Move the collated batches to the GPU inside the (forkserver) dataloader workers",
+    )
+    parser.add_argument(
+        "--pinned_pool_size",
+        default=0,
+        type=int,
+        help="Number of reusable pinned host buffers used to stage the batches before their copy to the GPU, 0 disables "
+        "the pool. Use at least 3 per batch in flight, eg 6",
+    )
 
     # Distributed training parameters
     parser.add_argument("--dist-url", default="env://", help="url used to set up distributed training")
@@ -216,6 +293,15 @@ def get_mem_info(prefix=''):
     return f'{prefix}GPU memory usage: {get_gpu_mem():.2f} MB, CPU memory usage: {get_cpu_mem():.2f} MB'
 
 
+def get_amp_dtype(args):
+    """Returns the autocast dtype requested by --amp/--amp_dtype, None when running in full precision"""
+    if not args.amp:
+        return None
+    if args.amp_dtype == "auto":
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    return {"fp16": torch.float16, "bf16": torch.bfloat16}[args.amp_dtype]
+
+
 def main(args):
     # Init distributed mode
 
@@ -268,7 +354,14 @@ def main(args):
     torch.manual_seed(seed)
     np.random.seed(seed)
     random.seed(seed)
-    #torch.set_deterministic(True)
+    # autotuning runs again for every new input shape, and the random resizes and crops give most batches a new one
+    torch.backends.cudnn.benchmark = args.cudnn_benchmark and not args.deterministic
+    torch.backends.cudnn.deterministic = args.deterministic
+    # TF32 tensor cores for the fp32 matmuls and convs, on Ampere and newer
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    if hasattr(torch, "set_float32_matmul_precision"):
+        torch.set_float32_matmul_precision("high")
 
     # Build the model
     if args.use_colo_zero:
@@ -286,41 +379,59 @@ def main(args):
         
     else:
         model, criterion, weight_dict = build_model(args)
+        if args.bf16_frozen_text_encoder:
+            assert args.freeze_text_encoder, "--bf16_frozen_text_encoder requires --freeze_text_encoder"
+            # forward-only weights, bf16 halves their memory and activations
+            model.transformer.text_encoder.to(dtype=torch.bfloat16)
         model.to(device)
 
 
 
-    # Get a copy of the model for exponential moving averaged version of the model
-    model_ema = deepcopy(model) if args.ema else None
     # ctx = ZeroInitContext(target_device=torch.cuda.current_device(),
     #                     shard_strategy=gpc.config.zero.model_config.shard_strategy,
     #                     shard_param=True)
     # with ctx:
     model_without_ddp = model
+    if args.compile:
+        if args.use_colo_zero or args.from_colossalai:
+            raise RuntimeError("--compile is not supported with the colossalai engine")
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("--compile requires torch>=2.0")
+        # batches of different image sizes are compiled separately
+        torch._dynamo.config.cache_size_limit = 64
+        # the text encoder and the tokenizer have graph breaks
+        model = torch.compile(model, mode="max-autotune", fullgraph=False, dynamic=False)
     if args.distributed and not args.from_colossalai:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True, broadcast_buffers=False)
-        model_without_ddp = model.module
+        # Some trainable parameters get no gradient (eg the pooler of the text encoder), and each step runs two forward
+        # calls through the wrapper (encode, then decode), so the graph can be neither static nor fully used
+        model = torch.nn.parallel.DistributedDataParallel(
+            model,
+            device_ids=[args.gpu],
+            find_unused_parameters=True,
+            broadcast_buffers=False,
+            gradient_as_bucket_view=True,
+        )
+    # Keep a running average of the trainable weights of the model for the exponential moving averaged version
+    model_ema = ModelEma(model_without_ddp) if args.ema else None
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print("number of params:", n_parameters)
 
 
     # Set up optimizers
+    param_groups = {"main": [], "backbone": [], "text_encoder": []}
+    for n, p in model_without_ddp.named_parameters():
+        if not p.requires_grad:
+            continue
+        if "backbone" in n:
+            param_groups["backbone"].append(p)
+        elif "text_encoder" in n:
+            param_groups["text_encoder"].append(p)
+        else:
+            param_groups["main"].append(p)
     param_dicts = [
-        {
-            "params": [
-                p
-                for n, p in model_without_ddp.named_parameters()
-                if "backbone" not in n and "text_encoder" not in n and p.requires_grad
-            ]
-        },
-        {
-            "params": [p for n, p in model_without_ddp.named_parameters() if "backbone" in n and p.requires_grad],
-            "lr": args.lr_backbone,
-        },
-        {
-            "params": [p for n, p in model_without_ddp.named_parameters() if "text_encoder" in n and p.requires_grad],
-            "lr": args.text_encoder_lr,
-        },
+        {"params": param_groups["main"]},
+        {"params": param_groups["backbone"], "lr": args.lr_backbone},
+        {"params": param_groups["text_encoder"], "lr": args.text_encoder_lr},
     ]
 
     if args.use_colo_zero:
@@ -330,16 +441,69 @@ def main(args):
         logger.info(get_mem_info(prefix='After init optim, '), ranks=[0])
     else:
         if args.optimizer == "sgd":
-            optimizer = torch.optim.SGD(param_dicts, lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
+            optimizer = build_multi_tensor_optimizer(
+                torch.optim.SGD,
+                param_dicts,
+                ["foreach"],
+                lr=args.lr,
+                momentum=0.9,
+                weight_decay=args.weight_decay,
+            )
+        elif args.optimizer in ["adam", "adamw"] and args.offload_optim:
+            assert not args.from_colossalai and not args.from_deepspeed, "offload_optim is only supported with plain torch"
+            optimizer = CPUOffloadOptimizer(
+                param_dicts,
+                CPUAdam,
+                lr=args.lr,
+                weight_decay=args.weight_decay,
+                adamw_mode=True,
+            )
         elif args.optimizer in ["adam", "adamw"]:
-            optimizer = torch.optim.AdamW(param_dicts, lr=args.lr, weight_decay=args.weight_decay)
+            optimizer = build_multi_tensor_optimizer(
+                torch.optim.AdamW,
+                param_dicts,
+                ["fused", "foreach"],
+                lr=args.lr,
+                weight_decay=args.weight_decay,
+            )
         else:
             raise RuntimeError(f"Unsupported optimizer {args.optimizer}")
 
+    # Mixed precision. Loss scaling is only needed for fp16, and colossalai and deepspeed scale the loss themselves
+    amp_dtype = get_amp_dtype(args)
+    scaler = torch.cuda.amp.GradScaler(
+        enabled=amp_dtype == torch.float16
+        and not args.use_colo_zero
+        and not args.from_colossalai
+        and not args.from_deepspeed
+    )
+
     # Train dataset
     if len(args.combine_datasets) == 0 and not args.eval:
         raise RuntimeError("Please provide at least one training dataset")
 
+    # Options shared by the train and val dataloaders
+    collate_device = None
+    if args.collate_to_device and device.type == "cuda":
+        # workers do not inherit the current device of the rank, so make it explicit
+        collate_device = torch.device("cuda", torch.cuda.current_device())
+    # batches are staged in pinned buffers reused across iterations rather than pinned by the dataloader
+    pinned_pool = None
+    if args.pinned_pool_size > 0 and device.type == "cuda" and collate_device is None:
+        pinned_pool = PinnedBatchPool(args.pinned_pool_size)
+    loader_kwargs = dict(
+        collate_fn=partial(utils.collate_fn, False, device=collate_device, pin_memory=pinned_pool is None),
+        num_workers=args.num_workers,
+        # batches collated on the GPU are not pinned
+        pin_memory=torch.cuda.is_available() and collate_device is None and pinned_pool is None,
+    )
+    if args.num_workers > 0:
+        # keep the workers (and their CUDA context) alive across epochs
+        loader_kwargs["persistent_workers"] = True
+        if collate_device is not None:
+            # CUDA can not be re-initialized in forked workers
+            loader_kwargs["multiprocessing_context"] = "forkserver"
+
     dataset_train, sampler_train, data_loader_train = None, None, None
     if not args.eval:
         #### temporal solution for update refexp_dataset_name and GT_type for multi-task finetuning
@@ -355,7 +519,13 @@ def main(args):
                 args.coco_path = coco_path_cache[ii]
                 dataset_list.append(build_dataset(name, image_set="train", args=args))
                 print(len(dataset_list[-1]),name,args.GT_type,args.refexp_dataset_name)
-            dataset_train = ConcatDataset(dataset_list)
+            dataset_train = RoundRobinIterableDataset(
+                dataset_list,
+                weights=args.multitask_weights,
+                seed=args.seed,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+            )
             args.GT_type, args.refexp_dataset_name = "merged_karpathy", "refcocog"
             args.flickr_img_path, args.coco_path = "data/Flickr30k/flickr30k_images_split/train", "data/coco"
         else:
@@ -363,19 +533,25 @@ def main(args):
                 [build_dataset(name, image_set="train", args=args) for name in args.combine_datasets]
             )
 
-        if args.distributed:
-            sampler_train = DistributedSampler(dataset_train)
+        if isinstance(dataset_train, RoundRobinIterableDataset):
+            # the dataset shards and shuffles itself
+            data_loader_train = DataLoader(dataset_train, args.batch_size, drop_last=True, **loader_kwargs)
         else:
-            sampler_train = torch.utils.data.RandomSampler(dataset_train)
+            if args.distributed:
+                sampler_train = DistributedSampler(dataset_train)
+            else:
+                sampler_train = torch.utils.data.RandomSampler(dataset_train)
 
-        batch_sampler_train = torch.utils.data.BatchSampler(sampler_train, args.batch_size, drop_last=True)
-        data_loader_train = DataLoader(
-            dataset_train,
-            batch_sampler=batch_sampler_train,
-            drop_last=False,
-            collate_fn=partial(utils.collate_fn, False),
-            num_workers=args.num_workers,
-        )
+            if args.aspect_ratio_group_factor >= 0:
+                group_ids = create_aspect_ratio_groups(dataset_train, k=args.aspect_ratio_group_factor)
+                batch_sampler_train = GroupedBatchSampler(sampler_train, group_ids, args.batch_size)
+            else:
+                batch_sampler_train = torch.utils.data.BatchSampler(sampler_train, args.batch_size, drop_last=True)
+            data_loader_train = DataLoader(
+                dataset_train,
+                batch_sampler=batch_sampler_train,
+                **loader_kwargs,
+            )
 
     # Val dataset
     if len(args.combine_datasets_val) == 0:
@@ -400,8 +576,7 @@ def main(args):
             args.batch_size,
             sampler=sampler,
             drop_last=False,
-            collate_fn=partial(utils.collate_fn, False),
-            num_workers=args.num_workers,
+            **loader_kwargs,
         )
         base_ds = get_coco_api_from_dataset(dset)
         val_tuples.append(Val_all(dataset_name=dset_name, dataloader=dataloader, base_ds=base_ds, evaluator_list=None))
@@ -417,7 +592,7 @@ def main(args):
             model_without_ddp.detr.load_state_dict(checkpoint["model"], strict=False)
 
         if args.ema:
-            model_ema = deepcopy(model_without_ddp)
+            model_ema.copy_from_model()
 
     # Used for loading weights from another model and starting a training from scratch. Especially useful if
     # loading into a model with different functionality.
@@ -432,7 +607,7 @@ def main(args):
         else:
             model_without_ddp.load_state_dict(checkpoint["model"], strict=False)
         if args.ema:
-            model_ema = deepcopy(model_without_ddp)
+            model_ema.copy_from_model()
 
     # Used for resuming training from the checkpoint of a model. Used when training times-out or is pre-empted.
     if args.resume:
@@ -444,15 +619,40 @@ def main(args):
         if not args.eval and "optimizer" in checkpoint and "epoch" in checkpoint:
             optimizer.load_state_dict(checkpoint["optimizer"])
             args.start_epoch = checkpoint["epoch"] + 1
+            # a disabled scaler (fp32 or bf16 runs) saves an empty state, which can't be loaded
+            if checkpoint.get("scaler"):
+                scaler.load_state_dict(checkpoint["scaler"])
         if args.ema:
             if "model_ema" not in checkpoint:
                 print("WARNING: ema model not found in checkpoint, resetting to current model")
-                model_ema = deepcopy(model_without_ddp)
+                model_ema.copy_from_model()
             else:
                 model_ema.load_state_dict(checkpoint["model_ema"])
 
+    @lru_cache(maxsize=None)
+    def prepare_evaluators(base_ds, dataset_name, do_caption):
+        """Helper function to load the annotations needed by the evaluators of a given dataset.
+        They are only read during the evaluation, so they are loaded once and shared by the evaluators of every epoch
+        """
+        prepared = {}
+        if "flickr" in dataset_name and do_caption:
+            prepared["roberta_vocab"] = load_roberta_vocab()
+        if args.no_detection:
+            return prepared
+        # the coco evaluation annotates the ground truth in place, so the dataset's annotations are copied
+        prepared["coco_gt"] = copy.deepcopy(base_ds)
+        if "flickr" in dataset_name:
+            prepared["flickr_recall"] = Flickr30kEntitiesRecallEvaluator(
+                args.flickr_dataset_path,
+                subset="test" if args.test else "val",
+                merge_boxes=args.GT_type == "merged",
+                verbose=False,
+            )
+        return prepared
+
     def build_evaluator_list(base_ds, dataset_name, do_caption):
         """Helper function to build the list of evaluators for a given dataset"""
+        prepared = prepare_evaluators(base_ds, dataset_name, do_caption)
         evaluator_list = []
         if "flickr" in dataset_name and do_caption:
             evaluator_list.append(
@@ -460,22 +660,24 @@ def main(args):
                     args.flickr_dataset_path,
                     subset="test" if args.test else "val",
                     merge_boxes=args.GT_type == "merged",
-                    exp_id=args.output_dir
+                    exp_id=args.output_dir,
+                    roberta_vocab=prepared["roberta_vocab"],
                 )
             )
         if args.no_detection:
             return evaluator_list
         iou_types = ["bbox"]
 
-        evaluator_list.append(CocoEvaluator(base_ds, tuple(iou_types), useCats=False))
+        evaluator_list.append(CocoEvaluator(prepared["coco_gt"], tuple(iou_types), useCats=False, copy_gt=False))
         if "refexp" in dataset_name:
-            evaluator_list.append(RefExpEvaluator(base_ds, ("bbox")))
+            evaluator_list.append(RefExpEvaluator(prepared["coco_gt"], ("bbox"), copy_gt=False))
         if "flickr" in dataset_name:
             evaluator_list.append(
                 FlickrEvaluator(
                     args.flickr_dataset_path,
                     subset="test" if args.test else "val",
                     merge_boxes=args.GT_type == "merged",
+                    recall_evaluator=prepared["flickr_recall"],
                 )
             )
         return evaluator_list
@@ -484,23 +686,26 @@ def main(args):
     # Runs only evaluation, by default on the validation set unless --test is passed.
     if args.eval:
         test_stats = {}
-        test_model = model_ema if model_ema is not None else model
-        for i, item in enumerate(val_tuples):
-            evaluator_list = build_evaluator_list(item.base_ds, item.dataset_name, args.do_caption)
-            postprocessors = build_postprocessors(args, item.dataset_name)
-            item = item._replace(evaluator_list=evaluator_list)
-            print(f"Evaluating {item.dataset_name}")
-            curr_test_stats = evaluate(
-                model=test_model,
-                criterion=criterion,
-                postprocessors=postprocessors,
-                weight_dict=weight_dict,
-                data_loader=item.dataloader,
-                evaluator_list=item.evaluator_list,
-                device=device,
-                args=args,
-            )
-            test_stats.update({item.dataset_name + "_" + k: v for k, v in curr_test_stats.items()})
+        # with ema, the model holds the averaged weights during evaluation
+        with model_ema.swap() if model_ema is not None else nullcontext(model) as test_model:
+            for i, item in enumerate(val_tuples):
+                evaluator_list = build_evaluator_list(item.base_ds, item.dataset_name, args.do_caption)
+                postprocessors = build_postprocessors(args, item.dataset_name)
+                item = item._replace(evaluator_list=evaluator_list)
+                print(f"Evaluating {item.dataset_name}")
+                curr_test_stats = evaluate(
+                    model=test_model,
+                    criterion=criterion,
+                    postprocessors=postprocessors,
+                    weight_dict=weight_dict,
+                    data_loader=item.dataloader,
+                    evaluator_list=item.evaluator_list,
+                    device=device,
+                    args=args,
+                    amp_dtype=amp_dtype,
+                    pinned_pool=pinned_pool,
+                )
+                test_stats.update({item.dataset_name + "_" + k: v for k, v in curr_test_stats.items()})
 
         log_stats = {
             **{f"test_{k}": v for k, v in test_stats.items()},
@@ -510,7 +715,7 @@ def main(args):
         return
 
     # init colossalai features
-    colossalai_engine = None
+    colossalai_engine, deepspeed_engine = None, None
     if args.from_colossalai:
         colossalai_engine, train_dataloader, test_dataloader, _ = colossalai.initialize(model,
                                                                      optimizer = optimizer,
@@ -535,63 +740,78 @@ def main(args):
     print("Start training")
     start_time = time.time()
     best_metric = 0.0
+    checkpoint_writer = AsyncCheckpointWriter() if args.output_dir else None
+    # opened once, and flushed after each epoch so that the stats survive a killed or preempted run
+    log_file = None
+    if args.output_dir and dist.is_main_process():
+        log_file = (output_dir / "log.txt").open("a", buffering=1024 * 1024)
+        atexit.register(log_file.close)
     for epoch in range(args.start_epoch, args.epochs):
         print(f"Starting epoch {epoch}")
-        if args.distributed:
+        if isinstance(dataset_train, RoundRobinIterableDataset):
+            dataset_train.set_epoch(epoch)
+        elif args.distributed:
             sampler_train.set_epoch(epoch)
-            train_stats = train_one_epoch(
-                model=model,
-                criterion=criterion,
-                data_loader=data_loader_train,
-                weight_dict=weight_dict,
-                optimizer=optimizer,
-                device=device,
-                epoch=epoch,
-                args=args,
-                max_norm=args.clip_max_norm,
-                model_ema=model_ema,
-                colossalai_engine = colossalai_engine,
-                deepspeed_engine = deepspeed_engine,
-            )
+        train_stats = train_one_epoch(
+            model=model,
+            criterion=criterion,
+            data_loader=data_loader_train,
+            weight_dict=weight_dict,
+            optimizer=optimizer,
+            device=device,
+            epoch=epoch,
+            args=args,
+            max_norm=args.clip_max_norm,
+            model_ema=model_ema,
+            colossalai_engine = colossalai_engine,
+            deepspeed_engine = deepspeed_engine,
+            scaler=scaler,
+            amp_dtype=amp_dtype,
+            pinned_pool=pinned_pool,
+        )
 
-        logger.info(f"Epoch {epoch} - train loss: {loss:.5}")
+        logger.info(f"Epoch {epoch} - train loss: {train_stats['loss']:.5}")
 
         if args.output_dir:
             checkpoint_paths = [output_dir / "checkpoint.pth"]
             # extra checkpoint before LR drop and every 2 epochs
             if (epoch + 1) % args.lr_drop == 0 or (epoch + 1) % 2 == 0:
                 checkpoint_paths.append(output_dir / f"checkpoint{epoch:04}.pth")
-            for checkpoint_path in checkpoint_paths:
-                dist.save_on_master(
-                    {
-                        "model": model_without_ddp.state_dict(),
-                        "model_ema": model_ema.state_dict() if args.ema else None,
-                        "optimizer": optimizer.state_dict(),
-                        "epoch": epoch,
-                        "args": args,
-                    },
-                    checkpoint_path,
-                )
+            # serialized once, the extra checkpoint is a hardlink to the same file
+            checkpoint_writer.save(
+                {
+                    "model": model_without_ddp.state_dict(),
+                    "model_ema": model_ema.state_dict() if args.ema else None,
+                    "optimizer": optimizer.state_dict(),
+                    "scaler": scaler.state_dict(),
+                    "epoch": epoch,
+                    "args": args,
+                },
+                checkpoint_paths,
+            )
 
         if epoch % args.eval_skip == 0:
             test_stats = {}
-            test_model = model_ema if model_ema is not None else model
-            for i, item in enumerate(val_tuples):
-                evaluator_list = build_evaluator_list(item.base_ds, item.dataset_name, args.do_caption)
-                item = item._replace(evaluator_list=evaluator_list)
-                postprocessors = build_postprocessors(args, item.dataset_name)
-                print(f"Evaluating {item.dataset_name}")
-                curr_test_stats = evaluate(
-                    model=test_model,
-                    criterion=criterion,
-                    postprocessors=postprocessors,
-                    weight_dict=weight_dict,
-                    data_loader=item.dataloader,
-                    evaluator_list=item.evaluator_list,
-                    device=device,
-                    args=args,
-                )
-                test_stats.update({item.dataset_name + "_" + k: v for k, v in curr_test_stats.items()})
+            # with ema, the model holds the averaged weights during evaluation
+            with model_ema.swap() if model_ema is not None else nullcontext(model) as test_model:
+                for i, item in enumerate(val_tuples):
+                    evaluator_list = build_evaluator_list(item.base_ds, item.dataset_name, args.do_caption)
+                    item = item._replace(evaluator_list=evaluator_list)
+                    postprocessors = build_postprocessors(args, item.dataset_name)
+                    print(f"Evaluating {item.dataset_name}")
+                    curr_test_stats = evaluate(
+                        model=test_model,
+                        criterion=criterion,
+                        postprocessors=postprocessors,
+                        weight_dict=weight_dict,
+                        data_loader=item.dataloader,
+                        evaluator_list=item.evaluator_list,
+                        device=device,
+                        args=args,
+                        amp_dtype=amp_dtype,
+                        pinned_pool=pinned_pool,
+                    )
+                    test_stats.update({item.dataset_name + "_" + k: v for k, v in curr_test_stats.items()})
         else:
             test_stats = {}
 
@@ -602,9 +822,9 @@ def main(args):
             "n_parameters": n_parameters,
         }
 
-        # if args.output_dir and dist.is_main_process():
-        with (output_dir / "log.txt").open("a") as f:
-            f.write(json.dumps(log_stats) + "\n")
+        if log_file is not None:
+            log_file.write(json.dumps(log_stats) + "\n")
+            log_file.flush()
 
         if epoch % args.eval_skip == 0:
             if args.do_caption:
@@ -614,21 +834,11 @@ def main(args):
 
             if args.output_dir and metric > best_metric:
                 best_metric = metric
-                checkpoint_paths = [output_dir / "BEST_checkpoint.pth"]
-                # extra checkpoint before LR drop and every 100 epochs
-                for checkpoint_path in checkpoint_paths:
-                    # dist.save_on_master(
-                    #     {
-                    #         "model": model_without_ddp.state_dict(),
-                    #         "model_ema": model_ema.state_dict() if args.ema else None,
-                    #         "optimizer": optimizer.state_dict(),
-                    #         "epoch": epoch,
-                    #         "args": args,
-                    #     },
-                    #     checkpoint_path,
-                    # )
-                    save_checkpoint(checkpoint_paths, epoch, model)
+                # the checkpoint of this epoch was saved above, there is no need to serialize it again
+                checkpoint_writer.link(output_dir / "checkpoint.pth", output_dir / "BEST_checkpoint.pth")
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print("Training time {}".format(total_time_str))
@@ -11,6 +11,7 @@ import torch.nn.functional as F
 import torchvision
 from timm.models import create_model
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from torchvision.models._utils import IntermediateLayerGetter
 
 from util.misc import NestedTensor
@@ -57,6 +58,21 @@ class FrozenBatchNorm2d(torch.nn.Module):
         return x * scale + bias
 
 
+class CheckpointSequential(nn.Sequential):
+    """
+    nn.Sequential whose blocks recompute their activations during backward instead of storing them.
+    The children, and thus the state_dict keys, are the same as the wrapped nn.Sequential.
+    """
+
+    def forward(self, x):
+        if self.training and x.requires_grad:
+            # non-reentrant, so that DDP sees the parameters of the blocks when it searches for the unused ones
+            for block in self:
+                x = checkpoint(block, x, use_reentrant=False)
+            return x
+        return super().forward(x)
+
+
 class BackboneBase(nn.Module):
     def __init__(self, backbone: nn.Module, train_backbone: bool, num_channels: int):
         super().__init__()
@@ -79,10 +95,13 @@ class BackboneBase(nn.Module):
 class Backbone(BackboneBase):
     """ResNet backbone with frozen BatchNorm."""
 
-    def __init__(self, name: str, train_backbone: bool, dilation: bool):
+    def __init__(self, name: str, train_backbone: bool, dilation: bool, gradient_checkpoint: bool = False):
         backbone = getattr(torchvision.models, name)(
             replace_stride_with_dilation=[False, False, dilation], pretrained=True, norm_layer=FrozenBatchNorm2d
         )
+        if gradient_checkpoint and train_backbone:
+            # the last stage holds the largest activations
+            backbone.layer4 = CheckpointSequential(*backbone.layer4)
         num_channels = 512 if name in ("resnet18", "resnet34") else 2048
         super().__init__(backbone, train_backbone, num_channels)
 
@@ -106,7 +125,7 @@ class Joiner(nn.Sequential):
 def build_backbone(args):
     position_embedding = build_position_encoding(args)
     train_backbone = args.lr_backbone > 0
-    backbone = Backbone(args.backbone, train_backbone, False)
+    backbone = Backbone(args.backbone, train_backbone, False, gradient_checkpoint=args.gradient_checkpoint)
     model = Joiner(backbone, position_embedding)
     model.num_channels = backbone.num_channels
     return model
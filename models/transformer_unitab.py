@@ -4,6 +4,7 @@ from typing import List, Optional
 import torch
 import torch.nn.functional as F
 from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
 from transformers import RobertaModel, RobertaTokenizerFast
 
 class DecoderEmbeddings(nn.Module):
@@ -54,6 +55,7 @@ class Transformer(nn.Module):
         freeze_text_encoder=False,
         num_queries=200,
         max_decoding_step=256,
+        gradient_checkpoint=False,
     ):
         super().__init__()
 
@@ -61,12 +63,18 @@ class Transformer(nn.Module):
         self.pass_pos_and_query = pass_pos_and_query
         encoder_layer = TransformerEncoderLayer(d_model, nhead, dim_feedforward, dropout, activation, normalize_before)
         encoder_norm = nn.LayerNorm(d_model) if normalize_before else None
-        self.encoder = TransformerEncoder(encoder_layer, num_encoder_layers, encoder_norm)
+        self.encoder = TransformerEncoder(
+            encoder_layer, num_encoder_layers, encoder_norm, gradient_checkpoint=gradient_checkpoint
+        )
 
         decoder_layer = TransformerDecoderLayer(d_model, nhead, dim_feedforward, dropout, activation, normalize_before)
         decoder_norm = nn.LayerNorm(d_model)
         self.decoder = TransformerDecoder(
-            decoder_layer, num_decoder_layers, decoder_norm, return_intermediate=return_intermediate_dec
+            decoder_layer,
+            num_decoder_layers,
+            decoder_norm,
+            return_intermediate=return_intermediate_dec,
+            gradient_checkpoint=gradient_checkpoint,
         )
 
         self._reset_parameters()
@@ -79,6 +87,8 @@ class Transformer(nn.Module):
         if freeze_text_encoder:
             for p in self.text_encoder.parameters():
                 p.requires_grad_(False)
+        # the text encoder is not checkpointed with gradient_checkpoint: transformers only checkpoints it reentrantly,
+        # which hides its parameters from the unused parameter search of DDP
 
         self.expander_dropout = 0.1
         config = self.text_encoder.config
@@ -96,6 +106,17 @@ class Transformer(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+    def encode_text(self, tokenized):
+        """Runs the text encoder, returns its last hidden state sequence first, in the dtype of the rest of the model"""
+        if self.text_encoder.embeddings.word_embeddings.weight.dtype == torch.bfloat16:
+            # the frozen text encoder was cast to bf16, keep it in bf16 whichever autocast dtype is in use outside
+            with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+                encoded_text = self.text_encoder(**tokenized)
+        else:
+            encoded_text = self.text_encoder(**tokenized)
+        # Transpose memory because pytorch's attention expects sequence first
+        return encoded_text.last_hidden_state.transpose(0, 1).to(self.resizer.fc.weight.dtype)
+
     def forward(
         self,
         src=None,
@@ -129,10 +150,7 @@ class Transformer(nn.Module):
             if isinstance(text[0], str):
                 # Encode the text
                 tokenized = self.tokenizer.batch_encode_plus(text, padding="max_length", max_length=max_encoding_step, truncation=True, return_tensors="pt").to(device)
-                encoded_text = self.text_encoder(**tokenized)
-
-                # Transpose memory because pytorch's attention expects sequence first
-                text_memory = encoded_text.last_hidden_state.transpose(0, 1)
+                text_memory = self.encode_text(tokenized)
                 # Invert attention mask that we get from huggingface because its the opposite in pytorch transformer
                 text_attention_mask = tokenized.attention_mask.ne(1).bool()
 
@@ -146,10 +164,7 @@ class Transformer(nn.Module):
                 tokenized = self.tokenizer.batch_encode_plus([''], padding="max_length", max_length=max_encoding_step, truncation=True, return_tensors="pt").to(device)
                 tokenized['input_ids'] = torch.stack([text[ii]['input_ids'] for ii in range(len(text))],dim=0).squeeze(1).to(device)[:,:tokenized['input_ids'].shape[-1]]
                 tokenized['attention_mask'] = torch.stack([text[ii]['attention_mask'] for ii in range(len(text))],dim=0).squeeze(1).to(device)[:,:tokenized['attention_mask'].shape[-1]]
-                encoded_text = self.text_encoder(**tokenized)
-
-                # Transpose memory because pytorch's attention expects sequence first
-                text_memory = encoded_text.last_hidden_state.transpose(0, 1)
+                text_memory = self.encode_text(tokenized)
                 # Invert attention mask that we get from huggingface because its the opposite in pytorch transformer
                 text_attention_mask = tokenized.attention_mask.ne(1).bool()
 
@@ -205,11 +220,12 @@ class Transformer(nn.Module):
             return hs.transpose(1, 2)
 
 class TransformerEncoder(nn.Module):
-    def __init__(self, encoder_layer, num_layers, norm=None):
+    def __init__(self, encoder_layer, num_layers, norm=None, gradient_checkpoint=False):
         super().__init__()
         self.layers = _get_clones(encoder_layer, num_layers)
         self.num_layers = num_layers
         self.norm = norm
+        self.gradient_checkpoint = gradient_checkpoint
 
     def forward(
         self,
@@ -222,7 +238,11 @@ class TransformerEncoder(nn.Module):
         output = src
 
         for layer in self.layers:
-            output = layer(output, src_mask=mask, src_key_padding_mask=src_key_padding_mask, pos=pos)
+            if self.gradient_checkpoint and self.training:
+                # recompute the activations of the layer during backward instead of storing them
+                output = checkpoint(layer, output, mask, src_key_padding_mask, pos, use_reentrant=False)
+            else:
+                output = layer(output, src_mask=mask, src_key_padding_mask=src_key_padding_mask, pos=pos)
 
         if self.norm is not None:
             output = self.norm(output)
@@ -231,12 +251,13 @@ class TransformerEncoder(nn.Module):
 
 
 class TransformerDecoder(nn.Module):
-    def __init__(self, decoder_layer, num_layers, norm=None, return_intermediate=False):
+    def __init__(self, decoder_layer, num_layers, norm=None, return_intermediate=False, gradient_checkpoint=False):
         super().__init__()
         self.layers = _get_clones(decoder_layer, num_layers)
         self.num_layers = num_layers
         self.norm = norm
         self.return_intermediate = return_intermediate
+        self.gradient_checkpoint = gradient_checkpoint
 
     def forward(
         self,
@@ -256,18 +277,35 @@ class TransformerDecoder(nn.Module):
         intermediate = []
 
         for layer in self.layers:
-            output = layer(
-                output,
-                memory,
-                text_memory=text_memory,
-                tgt_mask=tgt_mask,
-                memory_mask=memory_mask,
-                text_memory_key_padding_mask=text_memory_key_padding_mask,
-                tgt_key_padding_mask=tgt_key_padding_mask,
-                memory_key_padding_mask=memory_key_padding_mask,
-                pos=pos,
-                query_pos=query_pos,
-            )
+            if self.gradient_checkpoint and self.training:
+                # checkpoint only forwards positional arguments, in the order of TransformerDecoderLayer.forward
+                output = checkpoint(
+                    layer,
+                    output,
+                    memory,
+                    text_memory,
+                    tgt_mask,
+                    memory_mask,
+                    text_memory_key_padding_mask,
+                    tgt_key_padding_mask,
+                    memory_key_padding_mask,
+                    pos,
+                    query_pos,
+                    use_reentrant=False,
+                )
+            else:
+                output = layer(
+                    output,
+                    memory,
+                    text_memory=text_memory,
+                    tgt_mask=tgt_mask,
+                    memory_mask=memory_mask,
+                    text_memory_key_padding_mask=text_memory_key_padding_mask,
+                    tgt_key_padding_mask=tgt_key_padding_mask,
+                    memory_key_padding_mask=memory_key_padding_mask,
+                    pos=pos,
+                    query_pos=query_pos,
+                )
 
             if self.return_intermediate:
                 intermediate.append(self.norm(output))
@@ -519,6 +557,7 @@ def build_transformer(args):
         freeze_text_encoder=args.freeze_text_encoder,
         num_queries=args.num_queries,
         max_decoding_step=args.max_decoding_step,
+        gradient_checkpoint=args.gradient_checkpoint,
     )
 
 
@@ -0,0 +1,93 @@
+"""
+Checkpoint writer that serializes in a background thread, so that training is not blocked by the disk.
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import util.dist as dist
+
+
+class AsyncCheckpointWriter:
+    """Saves checkpoints from the main process in a single background thread.
+
+    The tensors of the checkpoint are first copied into host buffers that are reused across saves (pinned when CUDA is
+    available), since the training keeps updating the parameters and optimizer states in place while the file is
+    written. Only this copy blocks the caller; the serialization itself runs in the writer thread. A new save waits for
+    the previous one, so at most one checkpoint is staged at a time.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.staging = {}
+        self.pending = []
+
+    def _stage(self, obj, key=()):
+        if isinstance(obj, torch.Tensor):
+            obj = obj.detach()
+            buffer = self.staging.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, device="cpu")
+                if torch.cuda.is_available():
+                    buffer = buffer.pin_memory()
+                self.staging[key] = buffer
+            buffer.copy_(obj, non_blocking=True)
+            return buffer
+        if isinstance(obj, dict):
+            return type(obj)((k, self._stage(v, key + (k,))) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._stage(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    @staticmethod
+    def _write(obj, path):
+        # write to a temporary file first, so that a crash never leaves a truncated checkpoint and that hardlinks to
+        # the previous version of the file keep pointing to it
+        tmp_path = f"{path}.tmp"
+        torch.save(obj, tmp_path, _use_new_zipfile_serialization=True, pickle_protocol=4)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _link(src, dst):
+        tmp_path = f"{dst}.tmp"
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            # the filesystem does not support hardlinks
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+
+    def _save(self, obj, paths):
+        self._write(obj, paths[0])
+        for path in paths[1:]:
+            self._link(paths[0], path)
+
+    def save(self, obj, paths):
+        """Saves obj to the first of paths, the other paths being hardlinks to it"""
+        if not dist.is_main_process():
+            return
+        self.wait()
+        staged = self._stage(obj)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.pending.append(self.executor.submit(self._save, staged, [str(p) for p in paths]))
+
+    def link(self, src, dst):
+        """Hardlinks dst to the checkpoint src, once the pending save is written"""
+        if not dist.is_main_process():
+            return
+        self.pending.append(self.executor.submit(self._link, str(src), str(dst)))
+
+    def wait(self):
+        """Blocks until the pending writes are done, and raises their error if one failed"""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
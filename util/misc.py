@@ -35,7 +35,7 @@ def get_sha():
     return message
 
 
-def collate_fn(do_round, batch):
+def collate_fn(do_round, batch, device=None, pin_memory=True):
     batch = list(zip(*batch))
     final_batch = {}
     final_batch["samples"] = NestedTensor.from_tensor_list(batch[0], do_round)
@@ -80,6 +80,25 @@ def collate_fn(do_round, batch):
             answers[f] = torch.stack([b[f] for b in batch[1]])
         final_batch["answers"] = answers
 
+    if device is not None:
+        # The batch is moved to the GPU right away, which hides the H2D copy from the trainer when collating in workers
+        final_batch = apply_to_batch(final_batch, lambda t: t.to(device))
+    elif pin_memory and torch.cuda.is_available() and torch.utils.data.get_worker_info() is None:
+        # Pinned host memory lets the trainer issue non_blocking H2D copies. Inside DataLoader workers the pages would
+        # not survive the transfer to the main process, there the DataLoader pin_memory thread pins the batch instead.
+        final_batch = apply_to_batch(final_batch, lambda t: t.pin_memory())
+
+    return final_batch
+
+
+def apply_to_batch(final_batch, fn):
+    """Applies fn to the batched tensors of a collated batch. The per-sample targets are left untouched."""
+    final_batch["samples"] = fn(final_batch["samples"])
+    for k in ["positive_map", "positive_map_eval"]:
+        if k in final_batch:
+            final_batch[k] = fn(final_batch[k])
+    if "answers" in final_batch:
+        final_batch["answers"] = {k: fn(v) for k, v in final_batch["answers"].items()}
     return final_batch
 
 
@@ -93,6 +112,11 @@ class NestedTensor(object):
         cast_mask = self.mask.to(*args, **kwargs) if self.mask is not None else None
         return type(self)(cast_tensor, cast_mask)
 
+    def pin_memory(self):
+        pinned_tensor = self.tensors.pin_memory()
+        pinned_mask = self.mask.pin_memory() if self.mask is not None else None
+        return type(self)(pinned_tensor, pinned_mask)
+
     def decompose(self):
         return self.tensors, self.mask
 
@@ -159,4 +183,4 @@ def targets_to(targets: List[Dict[str, Any]], device):
         "task_id",
         "original_id",
     ]
-    return [{k: v.to(device) if k not in excluded_keys else v for k, v in t.items() if (k != "caption" and k != "output_caption")} for t in targets]
+    return [{k: v.to(device, non_blocking=True) if k not in excluded_keys else v for k, v in t.items() if (k != "caption" and k != "output_caption")} for t in targets]
@@ -1,28 +1,163 @@
 # Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
 """Collections of utilities related to optimization."""
 from bisect import bisect_right
+from contextlib import contextmanager
 
 import torch
 
 
-def update_ema(model, model_ema, decay):
-    """Apply exponential moving average update.
+class ModelEma:
+    """Exponential moving average of the trainable parameters of a model.
 
-    The  weights are updated in-place as follow:
+    Only the averaged tensors are kept (there is no second instance of the model), and they are updated in-place as
+    follow, with multi-tensor foreach kernels:
     w_ema = w_ema * decay + (1 - decay) * w
+    Frozen parameters and buffers do not change during training and are shared with the model.
     Args:
-        model: active model that is being optimized
-        model_ema: running average model
-        decay: exponential decay parameter
+        model: active model that is being optimized, without its DDP wrapper
     """
-    with torch.no_grad():
-        if hasattr(model, "module"):
-            # unwrapping DDP
-            model = model.module
-        msd = model.state_dict()
-        for k, ema_v in model_ema.state_dict().items():
-            model_v = msd[k].detach()
-            ema_v.copy_(ema_v * decay + (1.0 - decay) * model_v)
+
+    def __init__(self, model):
+        self.model = model
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.ema_params = [p.detach().clone() for p in self.params]
+
+    @torch.no_grad()
+    def update(self, decay):
+        """Apply exponential moving average update."""
+        if hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(self.ema_params, self.params, 1.0 - decay)
+        else:
+            torch._foreach_mul_(self.ema_params, decay)
+            torch._foreach_add_(self.ema_params, self.params, alpha=1.0 - decay)
+
+    @torch.no_grad()
+    def copy_from_model(self):
+        """Reset the running average to the current weights of the model."""
+        for ema_p, p in zip(self.ema_params, self.params):
+            ema_p.copy_(p)
+
+    @contextmanager
+    def swap(self):
+        """Context manager in which the model holds the averaged weights, eg for evaluation."""
+        live_data = [p.data for p in self.params]
+        for p, ema_p in zip(self.params, self.ema_params):
+            p.data = ema_p
+        try:
+            yield self.model
+        finally:
+            for p, data in zip(self.params, live_data):
+                p.data = data
+
+    def _ema_by_id(self):
+        return {id(p): ema_p for p, ema_p in zip(self.params, self.ema_params)}
+
+    def state_dict(self):
+        """Returns the state_dict of the averaged model, in the same format as the model's state_dict"""
+        ema_by_id = self._ema_by_id()
+        return {
+            k: ema_by_id[id(v)] if id(v) in ema_by_id else v.detach()
+            for k, v in self.model.state_dict(keep_vars=True).items()
+        }
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        """Loads the averaged parameters from the state_dict of an averaged model"""
+        ema_by_id = self._ema_by_id()
+        for k, v in self.model.state_dict(keep_vars=True).items():
+            if id(v) in ema_by_id:
+                ema_by_id[id(v)].copy_(state_dict[k])
+
+
+def build_multi_tensor_optimizer(optimizer_cls, param_dicts, implementations, **kwargs):
+    """Build the optimizer with the first of the requested implementations supported by the installed torch.
+
+    The fused implementation (torch>=2.0, CUDA parameters only) updates all the parameters in a single kernel, the
+    foreach one (torch>=1.12) batches the updates over the parameter list instead of launching kernels per tensor.
+    Falls back to the default per-parameter implementation if none is supported.
+    Args:
+        optimizer_cls: torch optimizer class to instantiate
+        param_dicts: parameter groups of the optimizer
+        implementations: keyword arguments selecting an implementation, by order of preference. eg ["fused", "foreach"]
+        kwargs: hyper-parameters of the optimizer
+    """
+    for implementation in implementations:
+        try:
+            # the optimizer fills its defaults into the groups in place, and may raise only after that: a failed
+            # attempt must not leave eg fused=True in the groups of the next one
+            return optimizer_cls([dict(group) for group in param_dicts], **kwargs, **{implementation: True})
+        except (TypeError, RuntimeError):
+            # TypeError: unknown keyword for this version of torch, RuntimeError: unsupported device or dtype
+            continue
+    return optimizer_cls([dict(group) for group in param_dicts], **kwargs)
+
+
+def _empty_pinned(shape):
+    return torch.empty(shape, dtype=torch.float32, pin_memory=torch.cuda.is_available())
+
+
+class CPUOffloadOptimizer(torch.optim.Optimizer):
+    """Optimizer keeping the fp32 master parameters and the optimizer states in host memory, as in ZeRO-Offload.
+
+    The wrapped optimizer (eg colossalai's CPUAdam) updates copies of the parameters held in pinned host memory. At
+    each step the gradients are copied to pinned host buffers, the update runs on the CPU and the updated parameters
+    are copied back to the device, so that no optimizer state is resident on the GPU.
+    The parameter groups of this optimizer hold the model parameters, so the lr schedule, gradient clipping and the
+    grad scaler are used as with any other optimizer. The state_dict is the one of the wrapped optimizer.
+    Args:
+        param_dicts: parameter groups of the optimizer
+        cpu_optimizer_cls: optimizer class updating the host copies of the parameters
+        kwargs: hyper-parameters of the optimizer
+    """
+
+    def __init__(self, param_dicts, cpu_optimizer_cls, **kwargs):
+        super().__init__(param_dicts, kwargs)
+        cpu_param_dicts = []
+        for group in self.param_groups:
+            cpu_group = {k: v for k, v in group.items() if k != "params"}
+            cpu_group["params"] = [_empty_pinned(p.shape) for p in group["params"]]
+            cpu_param_dicts.append(cpu_group)
+        self.cpu_optimizer = cpu_optimizer_cls(cpu_param_dicts, **kwargs)
+        # the master copies are filled at the first step, after the weights of a checkpoint may have been loaded
+        self.masters_synced = False
+
+    def _sync_hyperparameters(self):
+        for group, cpu_group in zip(self.param_groups, self.cpu_optimizer.param_groups):
+            cpu_group.update({k: v for k, v in group.items() if k != "params"})
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        assert closure is None, "closures are not supported by the offloaded optimizer"
+        self._sync_hyperparameters()
+        updated = []
+        for group, cpu_group in zip(self.param_groups, self.cpu_optimizer.param_groups):
+            for p, master in zip(group["params"], cpu_group["params"]):
+                if not self.masters_synced:
+                    master.copy_(p)
+                if p.grad is None:
+                    master.grad = None
+                    continue
+                if master.grad is None:
+                    master.grad = _empty_pinned(master.shape)
+                master.grad.copy_(p.grad, non_blocking=True)
+                updated.append((p, master))
+        self.masters_synced = True
+        if torch.cuda.is_available():
+            # wait for the gradient copies, and for the parameter copies of the previous step reading the masters
+            torch.cuda.synchronize()
+        self.cpu_optimizer.step()
+        for p, master in updated:
+            p.copy_(master, non_blocking=True)
+
+    def state_dict(self):
+        self._sync_hyperparameters()
+        return self.cpu_optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.cpu_optimizer.load_state_dict(state_dict)
+        for group, cpu_group in zip(self.param_groups, self.cpu_optimizer.param_groups):
+            group.update({k: v for k, v in cpu_group.items() if k != "params"})
+        self.masters_synced = False
 
 
 def adjust_learning_rate(
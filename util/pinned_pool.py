@@ -0,0 +1,81 @@
+"""
+Pool of pinned host buffers used to stage the collated batches before their copy to the GPU.
+"""
+import torch
+
+from util.misc import NestedTensor, apply_to_batch
+
+
+class PinnedBatchPool:
+    """Ring of pinned host buffers reused across iterations.
+
+    Pinning every collated batch allocates new page-locked memory (cudaHostAlloc) at each step, and the caching host
+    allocator rounds the variable sized padded batches up to powers of two. Instead, the batched tensors are copied
+    into the next buffers of the ring, from which the non_blocking host to device copies are issued. A buffer is only
+    handed out again once the copies reading from it have completed, which is tracked with a CUDA event.
+    Buffers grow to the largest tensor they have staged, so after warm-up no more pinned memory is allocated.
+
+    The staging copies run on the calling thread, in place of the background pin thread of the DataLoader. A batch
+    holds at least 3 tensors (images, mask, positive map), and a batch that does not fit in the free buffers is
+    pinned with tensor.pin_memory() as without the pool. The pool should thus hold at least 3 buffers per batch still
+    being copied to the GPU, eg 6 to stage a batch while the previous one is in flight.
+    """
+
+    def __init__(self, num_buffers):
+        self.buffers = [torch.empty(0, dtype=torch.uint8) for _ in range(num_buffers)]
+        self.events = [None] * num_buffers
+        self.next_idx = 0
+        self.in_flight = []
+
+    def _acquire(self, nbytes):
+        idx = self.next_idx
+        self.next_idx = (idx + 1) % len(self.buffers)
+        if self.events[idx] is not None:
+            # wait for the copy still reading from this buffer
+            self.events[idx].synchronize()
+            self.events[idx] = None
+        if self.buffers[idx].numel() < nbytes:
+            self.buffers[idx] = torch.empty(nbytes, dtype=torch.uint8).pin_memory()
+        self.in_flight.append(idx)
+        return self.buffers[idx]
+
+    def pin_tensor(self, tensor):
+        """Returns a copy of tensor in a pinned buffer of the pool"""
+        if tensor.is_cuda or tensor.is_pinned():
+            return tensor
+        # the pool is also used by evaluate, and buffers allocated under inference mode would be inference tensors,
+        # which can't be updated in-place during training afterwards
+        with torch.inference_mode(False):
+            return self._stage(tensor)
+
+    def _stage(self, tensor):
+        if len(self.in_flight) == len(self.buffers):
+            # every buffer is already staging a tensor of the current batch
+            return tensor.pin_memory()
+        nbytes = tensor.numel() * tensor.element_size()
+        staging = self._acquire(nbytes)[:nbytes].view(tensor.dtype).view(tensor.shape)
+        staging.copy_(tensor)
+        return staging
+
+    def pin(self, data):
+        if isinstance(data, NestedTensor):
+            mask = self.pin_tensor(data.mask) if data.mask is not None else None
+            return NestedTensor(self.pin_tensor(data.tensors), mask)
+        return self.pin_tensor(data)
+
+    def pin_batch(self, batch_dict):
+        """Stages the batched tensors of a collated batch in the pool"""
+        return apply_to_batch(batch_dict, self.pin)
+
+    def record(self):
+        """Marks the buffers staged since the last call as busy until the copies queued on the current stream are done.
+
+        Must be called after the non_blocking copies out of the staged tensors have been issued.
+        """
+        if not self.in_flight:
+            return
+        event = torch.cuda.Event()
+        event.record()
+        for idx in self.in_flight:
+            self.events[idx] = event
+        self.in_flight = []